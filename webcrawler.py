@@ -1,18 +1,112 @@
 import re
 import sys
 import time
-import requests
-from requests.exceptions import ConnectTimeout, ReadTimeout
-from urllib.parse import urlsplit, urljoin, unquote
+import asyncio
+import aiohttp
+import aiofiles
+import xxhash
+import yarl
+import math
+import functools
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from urllib.parse import urlsplit, unquote, quote, urlparse, urlunparse
 from urllib.robotparser import RobotFileParser
-from bs4 import BeautifulSoup
+from lxml import etree
 import os
 from enum import Enum
+from email.utils import parsedate_to_datetime
+from dataclasses import dataclass, field
 import pickle
+import gzip
+import sqlite3
 import signal
 import argparse
 
 
+# URLs are split at enqueue, dequeue and processing time, parse each one only once
+cached_urlsplit = functools.lru_cache(maxsize=50_000)(urlsplit)
+
+
+class HrefCollector:
+    """lxml parser target that collects <a> hrefs as the page is parsed, no tree is built"""
+
+    def __init__(self):
+        self.hrefs = []
+
+    def start(self, tag, attrib):
+        if tag == "a":
+            href = attrib.get("href")
+            if href is not None:
+                self.hrefs.append(href)
+
+    def close(self):
+        hrefs, self.hrefs = self.hrefs, []
+        return hrefs
+
+
+# <meta charset="..."> or <meta http-equiv="Content-Type" content="...; charset=...">, looked for near the top of the page
+META_CHARSET_RE = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?\s*([\w.:-]+)""", re.IGNORECASE)
+META_CHARSET_SCAN_BYTES = 4096
+
+
+@functools.lru_cache(maxsize=None)
+def get_href_parser(encoding):
+    """Built once per encoding and process, an explicit encoding keeps libxml2 from falling back to Latin-1"""
+    return etree.HTMLParser(target=HrefCollector(), recover=True, encoding=encoding)
+
+
+def get_page_encoding(raw_html, header_charset):
+    """Encoding of a page from the Content-Type charset, then <meta charset>, then UTF-8"""
+    if header_charset:
+        return header_charset
+    match = META_CHARSET_RE.search(raw_html, 0, META_CHARSET_SCAN_BYTES)
+    return match[1].decode("ascii") if match else "utf-8"
+
+
+def get_raw_urls_in_page(raw_html, header_charset=None):
+    """Extract hrefs from HTML"""
+    if not raw_html:
+        return []
+    try:
+        parser = get_href_parser(get_page_encoding(raw_html, header_charset).lower())
+    except LookupError:
+        parser = get_href_parser("utf-8")
+    return etree.fromstring(raw_html, parser)
+
+
+def get_normalized_urls(base_url, urls):
+    # Resolved against the page URL, fragments are dropped so they don't become separate frontier entries
+    base_url = yarl.URL(base_url)
+    normalized_urls = []
+    for url in urls:
+        try:
+            normalized_urls.append(base_url.join(yarl.URL(url)).with_fragment(None).human_repr())
+        except ValueError:
+            # Malformed hrefs such as broken IPv6 hosts could not be fetched anyway
+            continue
+    return normalized_urls
+
+
+def get_normalized_urls_in_page(raw_html, header_charset, base_url):
+    """Extract hrefs from HTML and resolve them against base_url, module level so it can run in a parse worker process"""
+    return get_normalized_urls(base_url, get_raw_urls_in_page(raw_html, header_charset))
+
+
+@functools.lru_cache(maxsize=100_000)
+def get_robots_path(url):
+    """Normalize a URL the way RobotFileParser.can_fetch does before matching rules, cached since pages share links"""
+    parsed_url = urlparse(unquote(url))
+    path = quote(urlunparse(("", "", parsed_url.path, parsed_url.params, parsed_url.query, parsed_url.fragment)))
+    return path or "/"
+
+
+def ignore_sigint():
+    # Parse workers share the terminal's process group, only the main process handles Ctrl+C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
 class ContentTypeException(Exception):
     def __init__(self, expected_content_type, actual_content_type):
         self.expected_content_type = expected_content_type
@@ -22,12 +116,176 @@ class ContentTypeException(Exception):
         return f"Expected content type: {self.expected_content_type}, actual content type: {self.actual_content_type}"
 
 
+class ContentTooLargeException(Exception):
+    def __init__(self, max_content_length, content_length=None):
+        self.max_content_length = max_content_length
+        self.content_length = content_length  # None when the body had no Content-Length and was cut off while reading
+
+    def __str__(self):
+        if self.content_length is None:
+            return f"Content longer than max content length: {self.max_content_length}"
+        return f"Content length: {self.content_length}, max content length: {self.max_content_length}"
+
+
 class ContentType(Enum):
     HTML = "text/html"
     XML = "application/xml"
     TXT = "text/plain"
 
 
+class BloomFilter:
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def get_bit_positions(self, hash_pair):
+        # Double hashing: k positions derived from two independent 64-bit hashes
+        h1, h2 = hash_pair
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def contains(self, hash_pair):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self.get_bit_positions(hash_pair))
+
+    def add(self, hash_pair):
+        for pos in self.get_bit_positions(hash_pair):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+
+class ScalableBloomFilter:
+    """Set-like URL filter that grows by chaining Bloom filters, may report false positives but never false negatives"""
+
+    GROWTH_FACTOR = 2  # Capacity multiplier for each new filter
+    TIGHTENING_RATIO = 0.5  # Error rate multiplier for each new filter, keeps the overall error rate bounded
+
+    def __init__(self, initial_capacity, error_rate):
+        self.filters = [BloomFilter(initial_capacity, error_rate * (1 - self.TIGHTENING_RATIO))]
+
+    def get_hash_pair(self, url):
+        digest = xxhash.xxh3_128_intdigest(url.encode())
+        return digest & 0xFFFFFFFFFFFFFFFF, (digest >> 64) | 1
+
+    def __contains__(self, url):
+        hash_pair = self.get_hash_pair(url)
+        return any(f.contains(hash_pair) for f in self.filters)
+
+    def __len__(self):
+        return sum(f.count for f in self.filters)
+
+    def add(self, url):
+        hash_pair = self.get_hash_pair(url)
+        if any(f.contains(hash_pair) for f in self.filters):
+            return
+        current_filter = self.filters[-1]
+        if current_filter.count >= current_filter.capacity:
+            current_filter = BloomFilter(
+                current_filter.capacity * self.GROWTH_FACTOR,
+                current_filter.error_rate * self.TIGHTENING_RATIO,
+            )
+            self.filters.append(current_filter)
+        current_filter.add(hash_pair)
+
+
+class RobotRules:
+    """Rules of a parsed robots.txt for one user agent, compiled into a single regex with the same verdicts as RobotFileParser.can_fetch
+    except that "*" and a trailing "$" in rule paths are wildcards as in Google's robots.txt spec"""
+
+    def __init__(self, rp: RobotFileParser, user_agent, robots_lines):
+        self.disallow_all = rp.disallow_all
+        self.allow_all = rp.allow_all
+        self.crawl_delay = self.parse_crawl_delay(robots_lines, user_agent)
+        self.site_maps = rp.site_maps()
+
+        # Only the first entry that applies to the user agent is used, falling back to the default entry
+        entry = next((e for e in rp.entries if e.applies_to(user_agent)), rp.default_entry)
+        rulelines = entry.rulelines if entry else []
+
+        # Rule lines are prefix matches tried in order, the first matching group decides the allowance
+        self.allowances = [line.allowance for line in rulelines]
+        self.rules_re = None
+        if rulelines:
+            self.rules_re = re.compile("|".join(f"({self.get_rule_pattern(line.path)})" for line in rulelines))
+
+    @staticmethod
+    def parse_crawl_delay(robots_lines, user_agent):
+        """Crawl-delay for the user agent from the same group RobotFileParser.crawl_delay uses, read as a float since RobotFileParser drops non-integer values"""
+        groups = []  # (user agents, crawl delay) in file order
+        user_agents, crawl_delay = [], None
+        state = 0  # Same states as RobotFileParser.parse: 0 start, 1 saw user-agent, 2 saw a rule
+        for line in robots_lines:
+            if not line and state:
+                if state == 2:
+                    groups.append((user_agents, crawl_delay))
+                user_agents, crawl_delay, state = [], None, 0
+            key, separator, value = line.split("#", 1)[0].partition(":")
+            if not separator:
+                continue
+            key, value = key.strip().lower(), unquote(value.strip())
+            if key == "user-agent":
+                if state == 2:
+                    groups.append((user_agents, crawl_delay))
+                    user_agents, crawl_delay = [], None
+                user_agents.append(value)
+                state = 1
+            elif key in ("allow", "disallow", "crawl-delay", "request-rate") and state:
+                if key == "crawl-delay":
+                    try:
+                        delay = float(value)
+                    except ValueError:
+                        delay = None
+                    if delay is not None and math.isfinite(delay) and delay >= 0:
+                        crawl_delay = delay
+                state = 2
+        if state == 2:
+            groups.append((user_agents, crawl_delay))
+
+        # The first group naming the user agent wins, otherwise the first "*" group
+        user_agent = user_agent.split("/")[0].lower()
+        default_groups = [delay for agents, delay in groups if "*" in agents]
+        for agents, delay in groups:
+            if "*" not in agents and any(agent.lower() in user_agent for agent in agents):
+                return delay
+        return default_groups[0] if default_groups else None
+
+    @staticmethod
+    def get_rule_pattern(path):
+        # RuleLine stores the path quoted, so the wildcards arrive as %2A and %24
+        end_anchor = path.endswith("%24")
+        if end_anchor:
+            path = path[:-3]
+        pattern = ".*".join(re.escape(part) for part in path.split("%2A"))
+        return pattern + r"\Z" if end_anchor else pattern
+
+    def can_fetch(self, url):
+        if self.disallow_all:
+            return False
+        if self.allow_all:
+            return True
+        if self.rules_re:
+            match = self.rules_re.match(get_robots_path(url))
+            if match:
+                return self.allowances[match.lastindex - 1]
+        return True
+
+
+@dataclass(slots=True)
+class NetlocState:
+    """Per-netloc bookkeeping, looked up once per URL instead of once per counter"""
+
+    page_count: int = 0
+    robots_txt_expires_at: float = 0.0  # time.time() after which robots.txt is fetched again
+    rp: RobotRules | None = None
+    pause_until: float = 0.0
+    consecutive_timeout_count: int = 0
+    consecutive_timeout_pause_count: int = 0
+    timeout_history: deque = field(default_factory=deque)  # URLs of the current run of consecutive timeouts, most recent first
+    consecutive_fetch_count: int = 0
+
+
 class WebCrawler:
     USER_AGENT = "SantaBot"
     FROM_EMAIL = "test@email.com"
@@ -41,7 +299,38 @@ class WebCrawler:
     NETLOC_CONSECUTIVE_TIMEOUT_INITIAL_PAUSE_SEC = 60  # Seconds to pause netloc before it can be retried (initial value of exponential backoff)
     NETLOC_CONSECUTIVE_TIMEOUT_PAUSE_LIMIT = 5 # How many times to retry a set of URLs in a netloc before giving up that set of URLs and reset exponential backoff
 
-    EXCLUDED_EXTENSIONS = {
+    # Concurrency limits
+    MAX_CONCURRENT_FETCHES = 64  # How many URLs can be fetched at the same time across all netlocs
+    NETLOC_MAX_CONCURRENT_FETCHES = 1  # How many URLs can be fetched at the same time within a netloc (1 keeps each netloc sequential)
+    FETCH_TIMEOUT_SEC = 5  # Total seconds allowed for a single request
+    DNS_CACHE_TTL_SEC = 300  # Seconds a resolved netloc is reused before it is looked up again
+    MAX_CONTENT_LENGTH = 10 * 1024 * 1024  # Bytes read from a single response before giving up on it
+
+    # Retries for transient HTTP errors, timeouts are handled by the netloc timeout limits instead
+    FETCH_RETRY_STATUSES = {429, 500, 502, 503, 504}
+    FETCH_MAX_RETRIES = 3
+    FETCH_RETRY_INITIAL_BACKOFF_SEC = 0.5  # Doubled after every retry
+    FETCH_RETRY_MAX_WAIT_SEC = 60  # Longest wait before a retry, a longer Retry-After gives up on the URL instead of holding its fetch slots
+
+    # Politeness
+    DEFAULT_CRAWL_DELAY_SEC = 1  # Seconds to wait between fetches within a netloc when robots.txt has no Crawl-delay
+    DISPATCH_IDLE_SEC = 0.25  # Seconds to wait before retrying when no netloc in the frontier can be fetched yet
+
+    # Fetch -> parse -> enqueue pipeline
+    PARSE_WORKERS = os.cpu_count() or 1  # How many processes extract URLs from fetched pages
+    PIPELINE_QUEUE_SIZE = 256  # How many pages can wait between two stages before the previous stage blocks
+
+    # robots.txt cache shared across runs
+    ROBOTS_CACHE_FILE_PATH = "robots_cache.db"
+    ROBOTS_CACHE_TTL_SEC = 12 * 3600  # Seconds a fetched robots.txt is used before it is fetched again
+    ROBOTS_RETRY_SEC = 600  # Seconds before retrying a robots.txt that could not be fetched
+    APPEND_FLUSH_LINES = 64  # How many lines are buffered for list_robots.txt / list_sitemap.txt before appending
+
+    # Visited URL filter sizing
+    VISITED_URLS_PER_HTML = 20  # Expected visited URLs per saved page, sizes the first Bloom filter so chaining is rare
+    VISITED_ERROR_RATE = 1e-4  # Probability of skipping a URL that was never visited
+
+    EXCLUDED_EXTENSIONS = frozenset({
         # Images
         ".jpg", ".jpeg", ".png", ".svg", ".gif", ".webp", ".bmp", ".tiff",
         # Documents
@@ -54,216 +343,384 @@ class WebCrawler:
         ".exe", ".dll", ".bin", ".bat", ".sh",
         # Other common file types
         ".css", ".js", ".json", ".xml", ".csv", ".txt",
-    }
+    })
+    # Characters replaced with "_" when building file paths
+    WINDOWS_PATH_TRANS = str.maketrans(dict.fromkeys('\\/:*?"<>|', "_"))
+    QUERY_PATH_TRANS = str.maketrans(dict.fromkeys('\\/:*?"<>|&', "_"))
+    HTM_RE = re.compile(r"\.htm(?!l)")  # ".htm" not already followed by "l"
+
+    # Gate for candidate URLs: http(s) scheme and ku.ac.th netloc, the path is captured for the extension check
+    URL_ACCEPT_RE = re.compile(r"^https?://(?P<netloc>[^/?#]*\.ku\.ac\.th)(?P<path>/[^?#]*)?(?:[?#].*)?$", re.IGNORECASE)
 
     def __init__(self, initial_urls, html_limit, netloc_page_limit, state_file_path=None):
         if state_file_path and os.path.exists(state_file_path):
             self.load_state(state_file_path)
         else:
-            self.frontier_q = initial_urls
-            self.visited = set()
+            self.frontier_by_netloc = {}  # netloc -> deque of urls waiting to be fetched, only netlocs with waiting urls
+            self.active_netlocs = deque()  # Round-robin order of the netlocs in frontier_by_netloc
+            self.frontier_set = set()
+            for url in initial_urls:
+                self.enqueue_url(url, cached_urlsplit(url).netloc)
+            self.visited = ScalableBloomFilter(max(html_limit * self.VISITED_URLS_PER_HTML, 1), self.VISITED_ERROR_RATE)
 
             self.HTML_LIMIT = html_limit
             self.html_count = 0
 
             self.NETLOC_PAGE_LIMIT = netloc_page_limit
-            self.netloc_page_count = {}
+            self.netlocs = defaultdict(NetlocState)
 
-            self.url_fetch_history = []
             self.last_fetch_timeout = False
-
-            self.netloc_seen = {}
-            self.netloc_rp = {}
-
-            self.netloc_pause_until = {}
-            self.netloc_consecutive_timeout_count = {}
-            self.netloc_consecutive_timeout_pause_count = {}
-            self.netloc_consecutive_fetch_count = {}
+            self.last_fetch_netloc = ""  # Netloc of the most recently started fetch
+            self.in_flight_urls = {}  # url -> netloc, dispatched but not fetched yet
+            self.pipeline_pages = {}  # url -> (raw html, Content-Type charset), fetched pages whose URLs have not been enqueued yet
+
+        # Runtime only, not part of the saved state
+        self.session = None
+        self.parse_pool = None
+        self.fetch_slots = asyncio.Semaphore(self.MAX_CONCURRENT_FETCHES)
+        self.netloc_fetch_counts = defaultdict(int)  # netloc -> fetches dispatched and not finished yet
+        self.netloc_robots_locks = defaultdict(asyncio.Lock)
+        self.netloc_next_ok = {}  # time.monotonic() at which the next fetch within a netloc may start
+        self.dirs_made = set()
+        self.parse_q = asyncio.Queue(maxsize=self.PIPELINE_QUEUE_SIZE)  # (url, raw html, Content-Type charset) waiting for URL extraction
+        self.enqueue_q = asyncio.Queue(maxsize=self.PIPELINE_QUEUE_SIZE)  # (url, normalized urls) waiting to be filtered into the frontier
+        self.robots_db = self.open_robots_db()
+        self.pending_lines = defaultdict(list)  # path -> lines waiting to be appended
 
     def save_state(self):
         """Save crawler state to a single pickle file"""
-        
+        self.flush_lines()
+
         state = {
-            'frontier_q': self.frontier_q,
+            'frontier_by_netloc': self.frontier_by_netloc,
             'visited': self.visited,
             'HTML_LIMIT': self.HTML_LIMIT,
             'html_count': self.html_count,
             'NETLOC_PAGE_LIMIT': self.NETLOC_PAGE_LIMIT,
-            'netloc_page_count': self.netloc_page_count,
-            'url_fetch_history': self.url_fetch_history,
+            'netlocs': self.netlocs,
             'last_fetch_timeout': self.last_fetch_timeout,
-            'netloc_seen': self.netloc_seen,
-            'netloc_rp': self.netloc_rp,
-            'netloc_pause_until': self.netloc_pause_until,
-            'netloc_consecutive_timeout_count': self.netloc_consecutive_timeout_count,
-            'netloc_consecutive_timeout_pause_count': self.netloc_consecutive_timeout_pause_count,
-            'netloc_consecutive_fetch_count': self.netloc_consecutive_fetch_count,
+            'last_fetch_netloc': self.last_fetch_netloc,
+            'in_flight_urls': self.in_flight_urls,
+            'pipeline_pages': self.pipeline_pages,
         }
 
         state_file_path = "crawler_state.pkl"
-        
-        with open(state_file_path, 'wb') as f:
-            pickle.dump(state, f)
+        tmp_state_file_path = f"{state_file_path}.tmp"
+
+        # Level 1 gzip is cheap and the state is mostly highly redundant URL strings
+        with gzip.open(tmp_state_file_path, 'wb', compresslevel=1) as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # Swapped in at once so a save cut short by a second Ctrl+C or a crash keeps the previous state loadable
+        os.replace(tmp_state_file_path, state_file_path)
 
         print(f"\nCrawler state saved to {state_file_path}")
 
     def load_state(self, state_file_path):
         """Load crawler state from pickle file"""
-        with open(state_file_path, 'rb') as f:
+        with gzip.open(state_file_path, 'rb') as f:
             state = pickle.load(f)
         
-        self.frontier_q = state['frontier_q']
+        self.frontier_by_netloc = state['frontier_by_netloc']
+        self.active_netlocs = deque(self.frontier_by_netloc)
+        self.frontier_set = set().union(*self.frontier_by_netloc.values())
         self.visited = state['visited']
         self.HTML_LIMIT = state['HTML_LIMIT']
         self.html_count = state['html_count']
         self.NETLOC_PAGE_LIMIT = state['NETLOC_PAGE_LIMIT']
-        self.netloc_page_count = state['netloc_page_count']
-        self.url_fetch_history = state['url_fetch_history']
+        self.netlocs = state['netlocs']
         self.last_fetch_timeout = state['last_fetch_timeout']
-        self.netloc_seen = state['netloc_seen']
-        self.netloc_rp = state['netloc_rp']
-        self.netloc_pause_until = state['netloc_pause_until']
-        self.netloc_consecutive_timeout_count = state['netloc_consecutive_timeout_count']
-        self.netloc_consecutive_timeout_pause_count = state['netloc_consecutive_timeout_pause_count']
-        self.netloc_consecutive_fetch_count = state['netloc_consecutive_fetch_count']
+        self.last_fetch_netloc = state['last_fetch_netloc']
+        # Fetches cut off by the interrupt are already in visited, so they go back to the front of the frontier
+        self.in_flight_urls = {}
+        for url, netloc in state['in_flight_urls'].items():
+            if url not in self.frontier_set:
+                self.enqueue_url(url, netloc, front=True)
+        # Pages fetched but not parsed yet are fed back into the pipeline when the crawl starts
+        self.pipeline_pages = state['pipeline_pages']
 
         print(f"Loaded crawler state from {state_file_path}")
 
-    def save_url_fetch_history(self, url):
-        # -> most recent, ..., least recent
-        # current_url is at index 0
-        self.url_fetch_history.insert(0, url)
-        if len(self.url_fetch_history) > self.NETLOC_CONSECUTIVE_TIMEOUT_PAUSE_TRIGGER:
-            self.url_fetch_history.pop()
-
-    def get_last_fetch_netloc(self):
-        if len(self.url_fetch_history) < 2:
-            return ""
-        return urlsplit(self.url_fetch_history[1]).netloc
-
-    def requeue_url_fetch_history(self):
-        for url in self.url_fetch_history:
-            self.frontier_q.insert(0, url)
-            try:
-                self.visited.remove(url)
-            except KeyError:
-                pass
-
-    def get_raw_document(self, url, expected_content_type: ContentType):
-        headers = {"User-Agent": self.USER_AGENT, "From": self.FROM_EMAIL}
-        response = requests.get(url, headers=headers, timeout=5)
-        response.raise_for_status()
-        actual_content_type = response.headers["content-type"]
-        if not expected_content_type.value in actual_content_type:
-            raise ContentTypeException(expected_content_type.value, actual_content_type)
-        if expected_content_type == ContentType.HTML:
-            soup = BeautifulSoup(response.content, "html.parser")
-            return soup.prettify().lower()
-        else:
-            return response.text
-
-    def get_raw_urls_in_page(self, raw_html):
-        soup = BeautifulSoup(raw_html, "html.parser")
-        return [a_tag["href"] for a_tag in soup.find_all("a", href=True)]
-
-    def get_normalized_urls(self, base_url, urls):
-        base_url_parts = urlsplit(base_url)
-        base_url = f"{base_url_parts.scheme}://{base_url_parts.netloc}"
-        return [unquote(urljoin(base_url, url)) for url in urls]
-
-    def write_file(self, path, text):
-        dirname, filename = os.path.split(path)
-        if dirname:
-            os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, "w", encoding="utf-8") as f:
-            f.write(text)
-
-    def append_file(self, path, text):
+    def open_robots_db(self):
+        """Open the SQLite robots.txt cache shared across runs"""
+        robots_db = sqlite3.connect(self.ROBOTS_CACHE_FILE_PATH)
+        robots_db.execute("PRAGMA journal_mode=WAL")
+        robots_db.execute("CREATE TABLE IF NOT EXISTS robots (netloc TEXT PRIMARY KEY, body TEXT, fetched_at REAL)")
+        return robots_db
+
+    def load_cached_robots_txt(self, netloc):
+        """Return (body, fetched_at) of the cached robots.txt for netloc, or None"""
+        return self.robots_db.execute("SELECT body, fetched_at FROM robots WHERE netloc = ?", (netloc,)).fetchone()
+
+    def save_cached_robots_txt(self, netloc, body, fetched_at):
+        with self.robots_db:
+            self.robots_db.execute("INSERT OR REPLACE INTO robots VALUES (?, ?, ?)", (netloc, body, fetched_at))
+
+    def requeue_timeout_history(self, netloc):
+        # URLs stay in visited, frontier_set already keeps them from being enqueued twice
+        # History is most recent first, so the least recent url ends up at the front of its netloc
+        timeout_history = self.netlocs[netloc].timeout_history
+        for url in timeout_history:
+            if url not in self.frontier_set:
+                self.enqueue_url(url, netloc, front=True)
+        timeout_history.clear()
+
+    async def get_raw_document(self, url, expected_content_type: ContentType):
+        retry_count = 0
+        while True:
+            async with self.session.get(url) as response:
+                retry_wait_sec = None
+                if response.status in self.FETCH_RETRY_STATUSES and retry_count < self.FETCH_MAX_RETRIES:
+                    # Never retry sooner than the host asked for, either through Retry-After or its Crawl-delay
+                    retry_wait_sec = max(
+                        self.FETCH_RETRY_INITIAL_BACKOFF_SEC * 2 ** retry_count,
+                        self.get_retry_after_sec(response),
+                        self.get_crawl_delay(cached_urlsplit(url).netloc),
+                    )
+                if retry_wait_sec is None or retry_wait_sec > self.FETCH_RETRY_MAX_WAIT_SEC:
+                    response.raise_for_status()
+                    actual_content_type = response.headers["content-type"]
+                    if not expected_content_type.value in actual_content_type:
+                        raise ContentTypeException(expected_content_type.value, actual_content_type)
+                    content = await self.read_content(response)
+                    if expected_content_type == ContentType.HTML:
+                        # The charset goes along with the bytes so the parse worker decodes hrefs correctly
+                        return content, response.charset
+                    else:
+                        # robots.txt is UTF-8 (RFC 9309), decode directly instead of resolving a charset
+                        return content.decode("utf-8", errors="replace")
+
+            # The connection is back in the pool while waiting to retry
+            await asyncio.sleep(retry_wait_sec)
+            retry_count += 1
+
+    def get_retry_after_sec(self, response):
+        # Retry-After is either a number of seconds or an HTTP date
+        retry_after = response.headers.get("Retry-After", "").strip()
+        if retry_after.isdigit():
+            return int(retry_after)
+        try:
+            return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return 0
+
+    async def read_content(self, response):
+        # Content-Length is checked before reading, bodies without one are cut off once they pass the limit
+        if response.content_length is not None and response.content_length > self.MAX_CONTENT_LENGTH:
+            raise ContentTooLargeException(self.MAX_CONTENT_LENGTH, response.content_length)
+        content = bytearray()
+        async for chunk in response.content.iter_chunked(64 * 1024):
+            content += chunk
+            if len(content) > self.MAX_CONTENT_LENGTH:
+                raise ContentTooLargeException(self.MAX_CONTENT_LENGTH)
+        return bytes(content)
+
+    async def make_dirs(self, dirname):
+        # Most pages share a netloc directory, only hit the filesystem the first time
+        if dirname in self.dirs_made:
+            return
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, os.makedirs, dirname, 0o777, True)
+        self.dirs_made.add(dirname)
+
+    async def write_file(self, path, content):
         dirname, filename = os.path.split(path)
         if dirname:
-            os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, "a+", encoding="utf-8") as f:
-            f.write(text)
+            await self.make_dirs(dirname)
+        if isinstance(content, bytes):
+            async with aiofiles.open(path, "wb") as f:
+                await f.write(content)
+        else:
+            async with aiofiles.open(path, "w", encoding="utf-8") as f:
+                await f.write(content)
+
+    def append_line(self, path, line):
+        # Lines are buffered and appended in batches instead of reopening the file for each one
+        pending_lines = self.pending_lines[path]
+        pending_lines.append(f"{line}\n")
+        if len(pending_lines) >= self.APPEND_FLUSH_LINES:
+            self.flush_lines(path)
+
+    def flush_lines(self, path=None):
+        for path in [path] if path else list(self.pending_lines):
+            pending_lines = self.pending_lines.pop(path, None)
+            if pending_lines:
+                with open(path, "a", encoding="utf-8") as f:
+                    f.writelines(pending_lines)
 
     def filter_and_enqueue_urls(self, urls):
-        for url in urls:
-            url_parts = urlsplit(url)
-            if (
-                url not in self.frontier_q
-                and url not in self.visited
-                and url_parts.scheme.startswith("http")
-                and url_parts.netloc.endswith(".ku.ac.th")
-                and not url_parts.path.endswith(tuple(self.EXCLUDED_EXTENSIONS))
-                and self.netloc_page_count.get(url_parts.netloc, 0) < self.NETLOC_PAGE_LIMIT
+        # Pages repeat navigation links, dedupe in page order so each URL goes through the checks once
+        for url in dict.fromkeys(urls):
+            match = self.URL_ACCEPT_RE.match(url)
+            if not match or url in self.frontier_set or url in self.visited:
+                continue
+            # Only the last path segment can carry an extension
+            path = match["path"] or ""
+            dot_index = path.rfind(".")
+            if dot_index > path.rfind("/") and path[dot_index:].lower() in self.EXCLUDED_EXTENSIONS:
+                continue
+            netloc_state = self.netlocs[match["netloc"]]
+            # Netlocs whose robots.txt is not handled yet are checked again when the URL is fetched
+            if netloc_state.page_count < self.NETLOC_PAGE_LIMIT and (
+                netloc_state.rp is None or netloc_state.rp.can_fetch(url)
             ):
-                self.frontier_q.append(url)
+                self.enqueue_url(url, match["netloc"])
+
+    def enqueue_url(self, url, netloc, front=False):
+        netloc_q = self.frontier_by_netloc.get(netloc)
+        if netloc_q is None:
+            netloc_q = self.frontier_by_netloc[netloc] = deque()
+            self.active_netlocs.append(netloc)
+        if front:
+            netloc_q.appendleft(url)
+        else:
+            netloc_q.append(url)
+        self.frontier_set.add(url)
+
+    def remove_netloc_from_frontier(self, netloc):
+        netloc_q = self.frontier_by_netloc.pop(netloc, None)
+        if netloc_q is not None:
+            self.active_netlocs.remove(netloc)
+            self.frontier_set.difference_update(netloc_q)
 
     def dequeue_url(self):
         current_time = time.time()
-        for i in range(len(self.frontier_q)):
-            url = self.frontier_q[i]
-            netloc = urlsplit(url).netloc
+        current_monotonic = time.monotonic()
+        # Skipped netlocs are rotated to the back, so the scan is over netlocs rather than urls
+        for _ in range(len(self.active_netlocs)):
+            netloc = self.active_netlocs[0]
+
+            # Skip netloc if it is paused
+            if current_time < self.netlocs[netloc].pause_until:
+                self.active_netlocs.rotate(-1)
+                continue
 
-            # Skip url if its netloc is paused
-            if netloc in self.netloc_pause_until and current_time < self.netloc_pause_until[netloc]:
+            # Skip netloc if it was fetched less than a crawl delay ago
+            if netloc in self.netloc_next_ok and current_monotonic < self.netloc_next_ok[netloc]:
+                self.active_netlocs.rotate(-1)
                 continue
 
-            return self.frontier_q.pop(i)
+            # Skip netloc if it has no free fetch slot
+            if self.netloc_fetch_counts[netloc] >= self.NETLOC_MAX_CONCURRENT_FETCHES:
+                self.active_netlocs.rotate(-1)
+                continue
+
+            # The slot is taken here, the dispatcher may dequeue again before the fetch task first runs
+            self.netloc_fetch_counts[netloc] += 1
+            self.netloc_next_ok[netloc] = current_monotonic + self.get_crawl_delay(netloc)
+            netloc_q = self.frontier_by_netloc[netloc]
+            url = netloc_q.popleft()
+            self.frontier_set.discard(url)
+
+            # Round robin, the netloc goes to the back if it still has urls waiting
+            self.active_netlocs.popleft()
+            if netloc_q:
+                self.active_netlocs.append(netloc)
+            else:
+                del self.frontier_by_netloc[netloc]
+            # The netloc travels with the url so later stages don't split it again
+            return url, netloc
 
-        return ""
+        return "", ""
     
     def clean_windows_path_characters(self, path):
-        return re.sub(r'[\\/:*?"<>|]', '_', path)
+        return path.translate(self.WINDOWS_PATH_TRANS)
 
     def get_html_file_path(self, url):
-        url_parts = urlsplit(url)
+        url_parts = cached_urlsplit(url)
 
-        path_part = url_parts.path.strip("/").replace(".htm", ".html")
-        if ".html" not in path_part:
-            path_part = "page.html" if path_part == "" else f"{path_part}/page.html"
+        path_part = self.HTM_RE.sub(".html", url_parts.path.strip("/"))
+        if ".html" in path_part:
+            path_part = path_part.replace(".html", "")
+        else:
+            path_part = "page" if path_part == "" else f"{path_part}/page"
 
-        path_part = path_part.replace(".html", "")
-        query_part = re.sub(r"[?&]", "_", url_parts.query)
-        query_part = self.clean_windows_path_characters(query_part)
+        query_part = url_parts.query.translate(self.QUERY_PATH_TRANS)
         fragment_part = self.clean_windows_path_characters(url_parts.fragment)
 
-        html_file_path = f"html/{url_parts.netloc}/{path_part}"
+        html_file_path = ["html/", url_parts.netloc, "/", path_part]
         if query_part:
-            html_file_path += f"_{query_part}"
+            html_file_path += ("_", query_part)
         if fragment_part:
-            html_file_path += f"_{fragment_part}"
-        html_file_path += ".html"
-
-        return html_file_path
+            html_file_path += ("_", fragment_part)
+        html_file_path.append(".html")
+
+        return "".join(html_file_path)
+
+    def parse_robots_txt(self, robots_txt):
+        robots_lines = robots_txt.splitlines()
+        rp = RobotFileParser()
+        rp.parse(robots_lines)
+        return RobotRules(rp, self.USER_AGENT, robots_lines)
+
+    async def try_get_and_parse_robots_txt(self, netloc):
+        # Other fetches within the netloc wait here until robots.txt has been handled
+        async with self.netloc_robots_locks[netloc]:
+            netloc_state = self.netlocs[netloc]
+            if time.time() < netloc_state.robots_txt_expires_at:
+                return
+
+            cached_robots_txt = self.load_cached_robots_txt(netloc)
+            if cached_robots_txt and time.time() - cached_robots_txt[1] < self.ROBOTS_CACHE_TTL_SEC:
+                robots_txt, fetched_at = cached_robots_txt
+                first_found = netloc_state.rp is None
+                # A NULL body is a robots.txt that was unavailable, which allows everything
+                netloc_state.rp = self.parse_robots_txt(robots_txt or "")
+                netloc_state.robots_txt_expires_at = fetched_at + self.ROBOTS_CACHE_TTL_SEC
+                # The outputs of this crawl don't depend on whether an earlier run left the cache behind
+                if first_found and robots_txt is not None:
+                    await self.record_robots_txt(netloc, robots_txt, netloc_state.rp)
+                return
 
-    def try_get_and_parse_robots_txt(self, netloc):
-        if netloc not in self.netloc_seen:
-            self.netloc_seen[netloc] = True
             robots_txt_url = f"https://{netloc}/robots.txt"
             try:
-                robots_txt = self.get_raw_document(robots_txt_url, ContentType.TXT)
+                try:
+                    robots_txt = await self.get_raw_document(robots_txt_url, ContentType.TXT)
+                except aiohttp.ClientResponseError as e:
+                    if not 400 <= e.status < 500 or e.status == 429:
+                        raise
+                    # An unavailable robots.txt allows everything (RFC 9309), cached like a fetched one
+                    print(f"No robots.txt for {netloc}: {e.status}")
+                    netloc_state.rp = self.parse_robots_txt("")
+                    netloc_state.robots_txt_expires_at = time.time() + self.ROBOTS_CACHE_TTL_SEC
+                    self.save_cached_robots_txt(netloc, None, time.time())
+                    return
 
                 # Below is only executed if the robots.txt is successfully fetched
                 print(f"Found robots.txt at {robots_txt_url}")
 
-                rp = RobotFileParser()
-                rp.parse(robots_txt.splitlines())
-                self.netloc_rp[netloc] = rp
-
-                robots_txt_file_path = f"html/{netloc}/robots.txt"
-                self.write_file(robots_txt_file_path, robots_txt)
-                self.append_file("list_robots.txt", f"{netloc}\n")
+                first_found = netloc_state.rp is None
+                rp = self.parse_robots_txt(robots_txt)
+                fetched_at = time.time()
+                netloc_state.rp = rp
+                netloc_state.robots_txt_expires_at = fetched_at + self.ROBOTS_CACHE_TTL_SEC
+                self.save_cached_robots_txt(netloc, robots_txt, fetched_at)
 
-                if rp.site_maps():
-                    print(f"Found sitemap at {rp.site_maps()}")
-                    self.append_file("list_sitemap.txt", f"{netloc}\n")
+                if first_found:
+                    await self.record_robots_txt(netloc, robots_txt, rp)
+                else:
+                    # Refetches after the TTL only refresh the rules and the saved file, the netloc is already listed
+                    await self.write_file(f"html/{netloc}/robots.txt", robots_txt)
 
             except (Exception) as e:
+                # Network errors and 5xx are retried later instead of leaving the netloc without rules for the rest of the crawl
+                netloc_state.robots_txt_expires_at = time.time() + self.ROBOTS_RETRY_SEC
                 print(f"Failed to get or parse robots.txt for {netloc}: {e}")
 
-    def crawl(self):
+    async def record_robots_txt(self, netloc, robots_txt, rp):
+        """Save the first robots.txt found for a netloc and list the netloc"""
+        await self.write_file(f"html/{netloc}/robots.txt", robots_txt)
+        self.append_line("list_robots.txt", netloc)
+
+        if rp.site_maps:
+            print(f"Found sitemap at {rp.site_maps}")
+            self.append_line("list_sitemap.txt", netloc)
+
+    async def crawl(self):
         def signal_handler(signum, frame):
             print("\nReceived interrupt signal. Saving state before exit...")
+            # Pages still waiting for a parse worker are saved with the state instead of parsed on the way out
+            if self.parse_pool:
+                self.parse_pool.shutdown(wait=False, cancel_futures=True)
             self.save_state()
             sys.exit(0)
 
@@ -274,99 +731,192 @@ class WebCrawler:
 
         start_time = time.time()
 
-        while len(self.frontier_q) > 0 and self.html_count < self.HTML_LIMIT:
-            current_url = self.dequeue_url()
+        headers = {"User-Agent": self.USER_AGENT, "From": self.FROM_EMAIL}
+        timeout = aiohttp.ClientTimeout(total=self.FETCH_TIMEOUT_SEC)
+        # Keep-alive connections are pooled per netloc and reused across fetches
+        connector = aiohttp.TCPConnector(
+            limit=self.MAX_CONCURRENT_FETCHES,
+            limit_per_host=self.NETLOC_MAX_CONCURRENT_FETCHES,
+            ttl_dns_cache=self.DNS_CACHE_TTL_SEC,
+        )
+        # Workers come from a forkserver, by the time they start the event loop already has executor threads that fork would copy
+        parse_pool = ProcessPoolExecutor(
+            max_workers=self.PARSE_WORKERS,
+            mp_context=multiprocessing.get_context("forkserver"),
+            initializer=ignore_sigint,
+        )
+        with parse_pool:
+            async with aiohttp.ClientSession(headers=headers, timeout=timeout, connector=connector) as session:
+                self.parse_pool = parse_pool
+                self.session = session
+                await self.run_pipeline()
+
+        self.flush_lines()
+        self.robots_db.close()
+        self.print_completion_time(start_time)
+
+    async def run_pipeline(self):
+        workers = [asyncio.create_task(self.parse_pages()) for _ in range(self.PARSE_WORKERS)]
+        workers.append(asyncio.create_task(self.enqueue_page_urls()))
+        tasks = set()
+
+        # Pages left in the pipeline by an interrupted run, written again in case the interrupt cut a write short
+        for url, (raw_html, charset) in list(self.pipeline_pages.items()):
+            try:
+                await self.write_file(self.get_html_file_path(url), raw_html)
+            except Exception as e:
+                self.uncount_page(url, cached_urlsplit(url).netloc)
+                print(f"Failed to write {url}: {e}")
+                continue
+            await self.parse_q.put((url, raw_html, charset))
+
+        # Pages still in the pipeline may add more URLs to an empty frontier
+        while (self.frontier_set or tasks or self.pipeline_pages) and self.html_count < self.HTML_LIMIT:
+            await self.fetch_slots.acquire()
+            current_url, current_netloc = self.dequeue_url()
             if not current_url:
-                time.sleep(1)
+                self.fetch_slots.release()
+                await asyncio.sleep(self.DISPATCH_IDLE_SEC)
                 continue
             self.visited.add(current_url)
+            self.in_flight_urls[current_url] = current_netloc
 
-            current_url_parts = urlsplit(current_url)
-            self.try_get_and_parse_robots_txt(current_url_parts.netloc)
-            if (
-                current_url_parts.netloc in self.netloc_rp
-                and not self.netloc_rp[current_url_parts.netloc].can_fetch(self.USER_AGENT, current_url)
-            ):
-                continue
+            task = asyncio.create_task(self.crawl_url(current_url, current_netloc))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
 
-            self.process_url(current_url)
-            time.sleep(1)
+        await asyncio.gather(*tasks)
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
 
-        self.print_completion_time(start_time)
+    async def parse_pages(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            current_url, raw_html, charset = await self.parse_q.get()
+            try:
+                normalized_urls = await loop.run_in_executor(
+                    self.parse_pool, get_normalized_urls_in_page, raw_html, charset, current_url
+                )
+            except Exception as e:
+                del self.pipeline_pages[current_url]
+                print(f"Failed to parse {current_url}: {e}")
+                continue
+            await self.enqueue_q.put((current_url, normalized_urls))
 
-    def handle_netloc_consecutive_fetch(self, current_netloc):
-        if not current_netloc in self.netloc_consecutive_fetch_count:
-            self.netloc_consecutive_fetch_count[current_netloc] = 0
+    async def enqueue_page_urls(self):
+        while True:
+            current_url, normalized_urls = await self.enqueue_q.get()
+            try:
+                old_frontier_size = len(self.frontier_set)
+                self.filter_and_enqueue_urls(normalized_urls)
+                print(f"    Found {len(self.frontier_set) - old_frontier_size} new urls in {current_url} ({len(self.frontier_set)} in frontier)")
+            except Exception as e:
+                print(f"Failed to enqueue URLs from {current_url}: {e}")
+            finally:
+                del self.pipeline_pages[current_url]
+
+    async def crawl_url(self, current_url, current_netloc):
+        # The netloc fetch slot was taken by dequeue_url
+        try:
+            await self.try_get_and_parse_robots_txt(current_netloc)
+            rp = self.netlocs[current_netloc].rp
+            if rp and not rp.can_fetch(current_url):
+                return
 
-        if self.get_last_fetch_netloc() == current_netloc:
-            self.netloc_consecutive_fetch_count[current_netloc] += 1
+            await self.process_url(current_url, current_netloc)
+        finally:
+            self.in_flight_urls.pop(current_url, None)
+            self.netloc_fetch_counts[current_netloc] -= 1
+            self.fetch_slots.release()
+
+    def uncount_page(self, url, netloc):
+        # A page that could not be written is taken back out of the pipeline and the page counts
+        del self.pipeline_pages[url]
+        self.html_count -= 1
+        self.netlocs[netloc].page_count -= 1
+
+    def get_crawl_delay(self, netloc):
+        rp = self.netlocs[netloc].rp
+        crawl_delay = rp.crawl_delay if rp else None
+        return crawl_delay if crawl_delay is not None else self.DEFAULT_CRAWL_DELAY_SEC
+
+    def handle_netloc_consecutive_fetch(self, current_netloc, last_fetch_netloc):
+        netloc_state = self.netlocs[current_netloc]
+
+        if last_fetch_netloc == current_netloc:
+            netloc_state.consecutive_fetch_count += 1
         else:
-            self.netloc_consecutive_fetch_count[current_netloc] = 1
-            if self.get_last_fetch_netloc():
-                self.netloc_consecutive_fetch_count[self.get_last_fetch_netloc()] = 0
+            netloc_state.consecutive_fetch_count = 1
+            if last_fetch_netloc:
+                self.netlocs[last_fetch_netloc].consecutive_fetch_count = 0
 
-        if self.netloc_consecutive_fetch_count[current_netloc] == self.NETLOC_CONSECUTIVE_FETCH_PAUSE_TRIGGER:
-            self.netloc_pause_until[current_netloc] = time.time() + self.NETLOC_CONSECUTIVE_FETCH_PAUSE_SEC
+        if netloc_state.consecutive_fetch_count == self.NETLOC_CONSECUTIVE_FETCH_PAUSE_TRIGGER:
+            netloc_state.pause_until = time.time() + self.NETLOC_CONSECUTIVE_FETCH_PAUSE_SEC
             print(f"{current_netloc} has reached max consecutive fetch count. Pausing for {self.NETLOC_CONSECUTIVE_FETCH_PAUSE_SEC} seconds")
 
-    def process_url(self, current_url):
-        current_netloc = urlsplit(current_url).netloc
+    async def process_url(self, current_url, current_netloc):
+        netloc_state = self.netlocs[current_netloc]
 
-        if current_netloc not in self.netloc_page_count:
-            self.netloc_page_count[current_netloc] = 0
-        if not current_netloc in self.netloc_consecutive_timeout_count:
-            self.netloc_consecutive_timeout_count[current_netloc] = 0
-        if not current_netloc in self.netloc_consecutive_timeout_pause_count:
-            self.netloc_consecutive_timeout_pause_count[current_netloc] = 0
+        # Taken before the fetch, other fetches started while this one is in flight don't count as previous
+        last_fetch_netloc = self.last_fetch_netloc
+        self.last_fetch_netloc = current_netloc
 
         current_fetch_timeout = False
         try:
-            self.save_url_fetch_history(current_url)
-            self.handle_netloc_consecutive_fetch(current_netloc)
-            raw_html = self.get_raw_document(current_url, ContentType.HTML)
+            self.handle_netloc_consecutive_fetch(current_netloc, last_fetch_netloc)
+            raw_html, charset = await self.get_raw_document(current_url, ContentType.HTML)
+
+            # Other fetches may have reached the limit while this one was in flight
+            if self.html_count >= self.HTML_LIMIT:
+                return
 
             # Below is only executed if the html is successfully fetched
-            html_file_path = self.get_html_file_path(current_url)
-            self.write_file(html_file_path, raw_html)
+            # Count the page before writing so other tasks see the limit while the file is written
+            # From here the page is saved with the state as part of the pipeline instead of as an in-flight url
+            self.in_flight_urls.pop(current_url, None)
+            self.pipeline_pages[current_url] = (raw_html, charset)
             self.html_count += 1
-            self.netloc_page_count[current_netloc] += 1
-            if self.netloc_page_count[current_netloc] == self.NETLOC_PAGE_LIMIT:
-                self.frontier_q = [url for url in self.frontier_q if urlsplit(url).netloc != current_netloc]
+            html_count = self.html_count
+            netloc_state.page_count += 1
+            html_file_path = self.get_html_file_path(current_url)
+            try:
+                await self.write_file(html_file_path, raw_html)
+            except Exception:
+                self.uncount_page(current_url, current_netloc)
+                raise
+            if netloc_state.page_count == self.NETLOC_PAGE_LIMIT:
+                self.remove_netloc_from_frontier(current_netloc)
                 print(f"Reached max pages for {current_netloc}. Removing from frontier")
-            print(f"#{self.html_count} Got html from {current_url}")
+            print(f"#{html_count} Got html from {current_url}")
 
-            self.netloc_consecutive_timeout_count[current_netloc] = 0
-            self.netloc_consecutive_timeout_count[self.get_last_fetch_netloc()] = 0
-            self.netloc_consecutive_timeout_pause_count[current_netloc] = 0
+            # Only this netloc's own success ends its run of timeouts
+            netloc_state.consecutive_timeout_count = 0
+            netloc_state.timeout_history.clear()
+            netloc_state.consecutive_timeout_pause_count = 0
 
-            raw_urls_in_page = self.get_raw_urls_in_page(raw_html)
-            normalized_urls = self.get_normalized_urls(current_url, raw_urls_in_page)
-            old_frontier_q_size = len(self.frontier_q)
-            self.filter_and_enqueue_urls(normalized_urls)
-            print(f"    Found {len(self.frontier_q) - old_frontier_q_size} new urls ({len(self.frontier_q)} in frontier)")
+            # URL extraction and enqueueing continue in the parse and enqueue stages
+            await self.parse_q.put((current_url, raw_html, charset))
 
-        except (ConnectTimeout, ReadTimeout):
+        except asyncio.TimeoutError:
             current_fetch_timeout = True
             print(f"Timeout fetching {current_url}")
 
-            # Handle netloc consecutive timeout
-            if current_netloc == self.get_last_fetch_netloc():
-                self.netloc_consecutive_timeout_count[current_netloc] += 1
-            else:
-                self.netloc_consecutive_timeout_count[current_netloc] = 1
-                if self.get_last_fetch_netloc():
-                    self.netloc_consecutive_timeout_count[self.get_last_fetch_netloc()] = 0
-            
-            if self.netloc_consecutive_timeout_count[current_netloc] == self.NETLOC_CONSECUTIVE_TIMEOUT_PAUSE_TRIGGER:
-                self.netloc_consecutive_timeout_count[current_netloc] = 0
-                self.netloc_consecutive_timeout_pause_count[current_netloc] += 1
-                if self.netloc_consecutive_timeout_pause_count[current_netloc] <= self.NETLOC_CONSECUTIVE_TIMEOUT_PAUSE_LIMIT:
-                    pause_duration = self.NETLOC_CONSECUTIVE_TIMEOUT_INITIAL_PAUSE_SEC * 2 ** (self.netloc_consecutive_timeout_pause_count[current_netloc] - 1)
-                    self.netloc_pause_until[current_netloc] = time.time() + pause_duration
-                    self.requeue_url_fetch_history()
+            # Handle netloc consecutive timeout, counted within the netloc so fetches of other netlocs in between don't break the run
+            netloc_state.consecutive_timeout_count += 1
+            netloc_state.timeout_history.appendleft(current_url)
+
+            if netloc_state.consecutive_timeout_count == self.NETLOC_CONSECUTIVE_TIMEOUT_PAUSE_TRIGGER:
+                netloc_state.consecutive_timeout_count = 0
+                netloc_state.consecutive_timeout_pause_count += 1
+                if netloc_state.consecutive_timeout_pause_count <= self.NETLOC_CONSECUTIVE_TIMEOUT_PAUSE_LIMIT:
+                    pause_duration = self.NETLOC_CONSECUTIVE_TIMEOUT_INITIAL_PAUSE_SEC * 2 ** (netloc_state.consecutive_timeout_pause_count - 1)
+                    netloc_state.pause_until = time.time() + pause_duration
+                    self.requeue_timeout_history(current_netloc)
                     print(f"{current_netloc} has reached max consecutive timeout count. Pausing for {pause_duration} seconds")
                 else:
-                    self.netloc_consecutive_timeout_pause_count[current_netloc] = 0
+                    netloc_state.consecutive_timeout_pause_count = 0
+                    netloc_state.timeout_history.clear()
                     print(f"{current_netloc} has exceeded consecutive timeout pause limit. Giving up on {self.NETLOC_CONSECUTIVE_TIMEOUT_PAUSE_TRIGGER} URLs")
 
         except Exception as e:
@@ -422,7 +972,7 @@ def main():
         state_file_path=args.state_file
     )
 
-    crawler.crawl()
+    asyncio.run(crawler.crawl())
 
 
 if __name__ == "__main__":